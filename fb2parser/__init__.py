@@ -1,8 +1,13 @@
+import functools
 import gettext
+import threading
+import time
 
 from bs4 import BeautifulSoup
 from bs4.element import NavigableString
-from fb2parser.constants import STRING_TAGS, GENRES, MESSAGES
+from fb2parser.constants import STRING_TAGS, GENRES, MESSAGES, DEFAULT_LIMITS
+from fb2parser.source import Source, StopParsing, StreamingTreeBuilder
+from fb2parser.validator import Validator
 
 
 class ParsingError(Exception):
@@ -29,16 +34,145 @@ class AttributeNotFound(ParsingError):
         ))
 
 
-class FB2Parser:
+class LimitExceeded(ParsingError):
+
+    def __init__(self, limit_name, limit):
+        super().__init__((
+            'LimitExceeded',
+            {'limit_name': limit_name, 'limit': limit},
+        ))
+
+
+class ResourceGuard:
+    """Enforces the limits from DEFAULT_LIMITS, None disables a limit.
+
+    The time limit applies to each parsing phase separately (building the tree,
+    parsing it), every phase starts the timer again with start_timer.
+    """
+
+    def __init__(self, **limits):
+        unknown = set(limits) - set(DEFAULT_LIMITS)
+        if unknown:
+            raise ValueError(f'Unknown limits: {", ".join(sorted(unknown))}')
+        self.limits = {**DEFAULT_LIMITS, **limits}
+        self.depth = 0
+        self.elements = 0
+        self.output_chars = 0
+        self.deadline = None
+
+    def start_timer(self):
+        if self.limits['max_time'] is not None:
+            self.deadline = time.monotonic() + self.limits['max_time']
+
+    def check(self, limit_name, value):
+        limit = self.limits[limit_name]
+        if limit is not None and value > limit:
+            raise LimitExceeded(limit_name, limit)
+
+    def check_time(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise LimitExceeded('max_time', self.limits['max_time'])
+
+    def enter_element(self):
+        self.depth += 1
+        self.elements += 1
+        self.check('max_depth', self.depth)
+        self.check('max_elements', self.elements)
+        self.check_time()
+
+    def leave_element(self):
+        self.depth -= 1
+
+    def reset_elements(self):
+        self.depth = 0
+        self.elements = 0
+
+    def add_output(self, text):
+        self.output_chars += len(text)
+        self.check('max_output_chars', self.output_chars)
+        self.check_time()
+
+
+class GuardedSoup(BeautifulSoup):
+    """BeautifulSoup that reports every element to a ResourceGuard while the tree is built.
+
+    If stop_after is set, the rest of the document is not read
+    after the first element with this name is closed.
+    """
+
+    def __init__(self, markup, guard, stop_after=None):
+        self.guard = guard
+        self.stop_after = stop_after
+        super().__init__(markup, builder=StreamingTreeBuilder)
+
+    def reset(self):
+        super().reset()
+        self.guard.reset_elements()
+
+    def handle_starttag(self, *args, **kwargs):
+        self.guard.enter_element()
+        return super().handle_starttag(*args, **kwargs)
+
+    def handle_endtag(self, name, *args, **kwargs):
+        self.guard.leave_element()
+        result = super().handle_endtag(name, *args, **kwargs)
+        if name == self.stop_after:
+            raise StopParsing
+        return result
+
+
+@functools.lru_cache(maxsize=None)
+def get_translation(lang):
+    try:
+        with open(f'{__path__[0]}/lang/{lang}.mo', 'rb') as f:
+            return gettext.GNUTranslations(f).gettext
+    except FileNotFoundError:
+        return lambda text: text
 
-    def __init__(self, raw, lang='en'):
-        self.soup = BeautifulSoup(raw, 'xml')
+
+def validate(raw, limits=None):
+    """Checks the document without rendering it and returns a list of all found problems.
+
+    raw accepts the same types as FB2Parser. Each problem is a tuple like
+    ('ElementNotFound', {'element_name': 'tr', 'path': '/FictionBook/body[1]/section[2]/table[1]', 'line': 40, 'fatal': True}).
+    The document is usable by FB2Parser.parse if there are no fatal problems.
+    """
+    validator = Validator(ResourceGuard(**(limits or {})))
+    validator.guard.start_timer()
+    try:
+        validator.run(raw)
+    except LimitExceeded as e:
+        validator.add_problem(*e.get_error(), True)
+    return validator.problems
+
+
+class FB2Parser:
+    """raw is the document as bytes or str (markup, not a file name),
+    a path-like object, an open binary file, an mmap, a memoryview or a bytearray.
+
+    Files and buffers are read in chunks without being copied into bytes.
+    With description_only=True the document is read only up to the end of
+    the first description, which is enough for parse_metadata.
+    """
+
+    def __init__(self, raw, lang='en', limits=None, description_only=False):
+        self.guard = ResourceGuard(**(limits or {}))
+        self.guard.start_timer()
+        if isinstance(raw, (bytes, str)):
+            self.guard.check('max_bytes', len(raw))
+        else:
+            raw = Source(raw, self.guard)
+        stop_after = 'description' if description_only else None
         try:
-            f = open(f'{__path__[0]}/lang/{lang}.mo', 'rb')
-            self._ = gettext.GNUTranslations(f).gettext
-            f.close()
-        except FileNotFoundError:
-            self._ = lambda text: text
+            self.soup = GuardedSoup(raw, self.guard, stop_after)
+        finally:
+            if isinstance(raw, Source):
+                raw.close()
+        self.data = None
+        self.parsed = False
+        self.parse_lock = threading.Lock()
+        self.lang = lang
+        self._ = get_translation(lang)
 
     def message_to_text(self, message):
         if isinstance(message, str):
@@ -47,12 +181,14 @@ class FB2Parser:
             message = (message[0], {})
         return self._(MESSAGES[message[0]]).format(**message[1])
 
-    def get_genre(self, genre):
+    def get_genre(self, genre, _=None):
+        _ = _ or self._
         if genre not in GENRES:
             return genre
-        return self._(GENRES[genre])
+        return _(GENRES[genre])
 
     def _parse(self):
+        self.guard.start_timer()
         self.data = {'descriptions': [], 'bodies': []}
         fb = self.soup.find('FictionBook')
         if not fb:
@@ -67,6 +203,37 @@ class FB2Parser:
         self._parse()
         return self.make_structure()
 
+    def render(self, html=False, lang=None):
+        """Like parse, but the document is parsed only on the first call,
+        so it can be rendered many times, e.g. in different languages.
+
+        lang overrides the language given to the constructor for this call only.
+        Rendering does not change the parser, so one parsed document can be
+        rendered from several threads.
+        """
+        self._parse_once()
+        return self.make_text(html, get_translation(lang or self.lang))
+
+    def render_structure(self, lang=None):
+        """Like parse_as_structure, see render."""
+        self._parse_once()
+        return self.make_structure(get_translation(lang or self.lang))
+
+    def _parse_once(self):
+        with self.parse_lock:
+            if not self.parsed:
+                self._parse()
+                self.parsed = True
+
+    def parse_metadata(self):
+        self.guard.start_timer()
+        fb = self.soup.find('FictionBook')
+        if not fb:
+            raise ElementNotFound('FictionBook')
+        if not fb.description:
+            raise ElementNotFound('description')
+        return [self.parse_description(c) for c in fb.children if c.name == 'description']
+
     def parse_fictionbook(self, fb):
         if not fb.description:
             raise ElementNotFound('description')
@@ -200,20 +367,23 @@ class FB2Parser:
             # raise ElementNotFound('author')
         # if not title_info.find('book-title'):
             # raise ElementNotFound('book-title')
-        data = {'genres': [], 'authors': [], 'translators': []}
+        data = {'genres': [], 'authors': [], 'author-names': [], 'translators': []}
         for c in title_info.children:
             if c.name == 'genre':
-                g = self.parse_genre_as_str(c)
+                g = self.parse_genre(c)
                 if g:
                     data['genres'].append(g)
             if c.name == 'author':
                 data['authors'].append(self.parse_author_as_text(c))
+                data['author-names'].append(self.get_full_name(c))
             if c.name == 'annotation':
                 data['annotation'] = self.parse_annotation_as_text(c)
             if c.name == 'translator':
                 data['translators'].append(self.parse_translator_as_text(c))
             if c.name == 'sequence':
                 data['sequence'] = self.parse_sequence_as_text(c)
+                data['sequence-name'] = c.get('name')
+                data['sequence-number'] = c.get('number')
             if not c.string:
                 continue
             if c.name == 'book-title':
@@ -251,13 +421,19 @@ class FB2Parser:
         if ci_ye:
             result += ci_ye + '\r\n'
             html_structure.append(['p', ci_ye])
-        return result, html_structure
-
-    def parse_genre_as_str(self, genre):
-        match = genre.get('match')
-        genre = self.get_genre(genre.string)
-        g = genre if not match else f'{genre} ({match}%)'
-        return g or None
+        isbn = publish_info.find('isbn')
+        fields = {
+            'publisher': publisher.string if publisher else None,
+            'city': city.string if city else None,
+            'year': year.string if year else None,
+            'isbn': isbn.string if isbn else None,
+        }
+        return result, html_structure, fields
+
+    def parse_genre(self, genre):
+        if not genre.string:
+            return None
+        return genre.string, genre.get('match')
 
     def parse_author_as_text(self, author):
         return self.parse_people_as_text(author)
@@ -274,15 +450,11 @@ class FB2Parser:
             result += f' #{sequence["number"]}'
         return result, [['p', result]]
 
-    def parse_people_as_text(self, p):
+    def get_full_name(self, p):
         fn = p.find('first-name')
         mn = p.find('middle-name')
         ln = p.find('last-name')
         nn = p.find('nickname')
-        hp = p.find('home-page')
-        hp = hp.string if hp and hp.string else None
-        email = p.find('email')
-        email = email.string if email and email.string else None
         full_name_list = []
         if ln and ln.string:
             full_name_list.append(ln.string)
@@ -292,7 +464,14 @@ class FB2Parser:
             full_name_list.append(mn.string)
         if nn and nn.string:
             full_name_list.append('(' + nn.string + ')')
-        full_name = ' '.join(full_name_list)
+        return ' '.join(full_name_list)
+
+    def parse_people_as_text(self, p):
+        hp = p.find('home-page')
+        hp = hp.string if hp and hp.string else None
+        email = p.find('email')
+        email = email.string if email and email.string else None
+        full_name = self.get_full_name(p)
         p = []
         html_structure = []
         if full_name:
@@ -348,6 +527,7 @@ class FB2Parser:
     def get_text(self, element, container='p'):
         if isinstance(element, NavigableString):
             element = str(element)
+            self.guard.add_output(element)
             return element, [[container, element.strip()]]
         for a in element.find_all('a'):
             for k, v in list(a.attrs.items()):
@@ -357,7 +537,9 @@ class FB2Parser:
                         a['name'] = 'return_' + v[1:]
                         v = '#bunch_' + v[1:]
                     a['href'] = v
-        return element.get_text(), [[container, element.prettify().strip()]]
+        text = element.get_text()
+        self.guard.add_output(text)
+        return text, [[container, element.prettify().strip()]]
 
     def parse_line_as_text(self, line):
         t = self.get_text(line)
@@ -492,6 +674,7 @@ class FB2Parser:
         for c in tr.children:
             if c.name == 'th' or c.name == 'td':
                 items.append(c.get_text())
+                self.guard.add_output(items[-1])
         return '\t'.join(items) + '\r\n'
 
     def parse_text_author_as_text(self, text_author):
@@ -522,14 +705,11 @@ class FB2Parser:
         t = self.get_text(v)
         return t[0] + '\r\n', t[1]
 
-    def make_text_from_some_title_info(self, data, set_book_title=False):
+    def make_text_from_some_title_info(self, data, _=None):
+        _ = _ or self._
         result = ''
         html_structure = []
-        if set_book_title:
-            self.data['book-title'] = '---'
         if 'book-title' in data:
-            if set_book_title:
-                self.data['book-title'] = data['book-title']
             result += data['book-title'] + '\r\n'
             html_structure.append(['h1', data['book-title']])
         if 'sequence' in data:
@@ -544,9 +724,9 @@ class FB2Parser:
             add = True
         html_structure.append([None, '<br/>'])
         if data['translators']:
-            temp = self._(MESSAGES['translator'])
+            temp = _(MESSAGES['translator'])
             if len(data['translators'])-1:
-                temp = self._(MESSAGES['translators'])
+                temp = _(MESSAGES['translators'])
             result += temp + ': \r\n' + ('\r\n'.join(t[0] for t in data['translators'])) + '\r\n'
             html_structure.append(['p', temp + ': '])
             add = False
@@ -557,50 +737,56 @@ class FB2Parser:
                 add = True
             html_structure.append([None, '<br/>'])
         if data['genres']:
-            genres = ', '.join(data['genres'])
+            genres = ', '.join(self.make_text_from_genre(g, _) for g in data['genres'])
             result += '\r\n' + genres + '\r\n'
             html_structure.append(['p', genres])
         if 'lang' in data:
-            temp = self._(MESSAGES['language']) + ': '
+            temp = _(MESSAGES['language']) + ': '
             result += temp + data['lang'] + '\r\n'
             html_structure.append(['p', temp + data['lang']])
         if 'src-lang' in data:
-            temp = self._(MESSAGES['original_language']) + ': '
+            temp = _(MESSAGES['original_language']) + ': '
             result += temp + data['src-lang'] + '\r\n'
             html_structure.append(['p', temp + data['src-lang']])
         if 'date' in data:
-            temp = self._(MESSAGES['date']) + ': '
+            temp = _(MESSAGES['date']) + ': '
             result += temp + data['date'] + '\r\n'
             html_structure.append(['p', temp + data['date']])
         if 'annotation' in data:
-            temp = self._(MESSAGES['annotation'])
+            temp = _(MESSAGES['annotation'])
             result += temp + ': \r\n' + data['annotation'][0] + '\r\n'
             html_structure.append(['h1', temp])
             html_structure += data['annotation'][1]
         return result, html_structure
 
-    def make_text(self, html=False):
+    def make_text_from_genre(self, genre, _=None):
+        name = self.get_genre(genre[0], _)
+        return name if not genre[1] else f'{name} ({genre[1]}%)'
+
+    def make_text(self, html=False, _=None):
+        _ = _ or self._
         result = ''
         html_structure = []
         contents_index = 0
-        get_book_title = True
+        book_title = None
         for description in self.data['descriptions']:
             for title_info in description['title-infos']:
-                t = self.make_text_from_some_title_info(title_info, get_book_title)
-                get_book_title = False
+                t = self.make_text_from_some_title_info(title_info, _)
+                if book_title is None:
+                    book_title = title_info.get('book-title', '---')
                 contents_index += len(t[1])
                 result += t[0] + '\r\n'
                 html_structure += t[1]
             for src_title_info in description['src-title-infos']:
-                t = self.make_text_from_some_title_info(src_title_info)
-                temp = self._(MESSAGES['original_metadata'])
+                t = self.make_text_from_some_title_info(src_title_info, _)
+                temp = _(MESSAGES['original_metadata'])
                 result += temp + ': \r\n' + t[0] + '\r\n'
                 contents_index += 1 + len(t[1])
                 html_structure.append(['p', temp + ': '])
                 html_structure += t[1]
             for publish_info in description['publish-infos']:
                 t = publish_info
-                temp = self._(MESSAGES['edition_information'])
+                temp = _(MESSAGES['edition_information'])
                 result += temp + ': \r\n' + t[0] + '\r\n'
                 contents_index += 1 + len(t[1])
                 html_structure.append(['p', temp + ': '])
@@ -628,7 +814,7 @@ class FB2Parser:
                 else:
                     item = f'<{html_item[0]}>{html_item[1]}</{html_item[0]}>'
             clean_html_structure.append(item)
-        contents_html = f'''<h1>{self._(MESSAGES['contents'])}</h1>
+        contents_html = f'''<h1>{_(MESSAGES['contents'])}</h1>
 <ul style="list-style: none;">
 {(chr(13) + chr(10)).join(f'<li><a href="#{item[1]}">{item[0]}</a></li>' for item in contents)}
 </ul>'''
@@ -636,22 +822,23 @@ class FB2Parser:
         return f'''<html>
 <head>
 <meta charset="UTF-8"/>
-<title>{self.data["book-title"]}</title>
+<title>{book_title or '---'}</title>
 </head>
 <body>
 {(chr(13) + chr(10)).join(clean_html_structure)}
 </body>
 </html>'''
 
-    def make_structure(self):
+    def make_structure(self, _=None):
+        _ = _ or self._
         result = ''
         for description in self.data['descriptions']:
             for title_info in description['title-infos']:
-                result += self.make_text_from_some_title_info(title_info)[0] + '\r\n'
+                result += self.make_text_from_some_title_info(title_info, _)[0] + '\r\n'
             for src_title_info in description['src-title-infos']:
-                result += self._(MESSAGES['original_metadata']) + ': \r\n' + self.make_text_from_some_title_info(src_title_info)[0] + '\r\n'
+                result += _(MESSAGES['original_metadata']) + ': \r\n' + self.make_text_from_some_title_info(src_title_info, _)[0] + '\r\n'
             for publish_info in description['publish-infos']:
-                result += self._(MESSAGES['edition_information']) + ': \r\n' + publish_info[0] + '\r\n'
+                result += _(MESSAGES['edition_information']) + ': \r\n' + publish_info[0] + '\r\n'
         result = [result]
         [result.extend(b[1]) for b in self.data['bodies']]
         return result
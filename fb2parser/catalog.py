@@ -0,0 +1,207 @@
+import csv
+import json
+import os
+import zipfile
+from pathlib import Path
+
+from fb2parser import FB2Parser, ParsingError, ElementNotFound
+
+CATALOG_FIELDS = [
+    'path',
+    'title',
+    'authors',
+    'genres',
+    'sequence_name',
+    'sequence_number',
+    'lang',
+    'src_lang',
+    'date',
+    'publisher',
+    'publish_city',
+    'publish_year',
+    'isbn',
+    'error',
+]
+
+
+def to_str(value):
+    return None if value is None else str(value).strip()
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def iter_records(paths, limits=None):
+    """Yields a record (see make_record) for every .fb2 file in paths.
+
+    paths may contain .fb2 files, zip archives and directories, which are walked recursively.
+    Members of archives are streamed from the archive without being extracted.
+    An archive or a member that can not be opened gets an error record.
+    """
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                yield from iter_records((Path(root, f) for f in sorted(files) if is_book(f)), limits)
+        elif path.suffix.lower() == '.zip':
+            try:
+                archive = zipfile.ZipFile(path)
+            except Exception as e:
+                yield make_error_record(str(path), e)
+                continue
+            with archive:
+                for member in archive.infolist():
+                    if member.is_dir() or not member.filename.lower().endswith('.fb2'):
+                        continue
+                    name = f'{path}/{member.filename}'
+                    try:
+                        f = archive.open(member)
+                    except Exception as e:
+                        yield make_error_record(name, e)
+                        continue
+                    with f:
+                        yield make_record(name, f, limits)
+        else:
+            yield make_record(str(path), path, limits)
+
+
+def is_book(filename):
+    return filename.lower().endswith(('.fb2', '.zip'))
+
+
+def make_record(name, source, limits=None):
+    """Parses the first description of a book into a flat record with CATALOG_FIELDS.
+
+    The book is read only up to the end of the description.
+    Books that can not be read or parsed get an error record, see make_error_record.
+    """
+    try:
+        description = FB2Parser(source, limits=limits, description_only=True).parse_metadata()[0]
+        # parse_description finds title-info anywhere, but collects only direct children.
+        if not description['title-infos']:
+            raise ElementNotFound('title-info')
+    except Exception as e:
+        return make_error_record(name, e)
+    record = dict.fromkeys(CATALOG_FIELDS)
+    record['path'] = name
+    title_info = description['title-infos'][0]
+    record.update({
+        'title': to_str(title_info.get('book-title')),
+        'authors': [to_str(a) for a in title_info['author-names'] if a],
+        'genres': [{'genre': to_str(g[0]), 'match': to_int(g[1])} for g in title_info['genres']],
+        'sequence_name': to_str(title_info.get('sequence-name')),
+        'sequence_number': to_int(title_info.get('sequence-number')),
+        'lang': to_str(title_info.get('lang')),
+        'src_lang': to_str(title_info.get('src-lang')),
+        'date': to_str(title_info.get('date')),
+    })
+    if description['publish-infos']:
+        fields = description['publish-infos'][0][2]
+        record.update({
+            'publisher': to_str(fields['publisher']),
+            'publish_city': to_str(fields['city']),
+            'publish_year': to_int(fields['year']),
+            'isbn': to_str(fields['isbn']),
+        })
+    return record
+
+
+def make_error_record(name, error):
+    """A record with only path and error set."""
+    record = dict.fromkeys(CATALOG_FIELDS)
+    record['path'] = name
+    if isinstance(error, ParsingError):
+        error_name, params = error.get_error()
+        record['error'] = f'{error_name}({", ".join(f"{k}={v}" for k, v in params.items())})'
+    else:
+        record['error'] = f'{type(error).__name__}: {error}'
+    return record
+
+
+def export_catalog(paths, writer, batch_size=1000, limits=None):
+    """Writes records of all books from paths (see iter_records) to writer in batches of batch_size.
+
+    Only one batch is kept in memory at a time. Returns the number of written records.
+    """
+    batch = []
+    count = 0
+    for record in iter_records(paths, limits):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            writer.write_batch(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        writer.write_batch(batch)
+        count += len(batch)
+    return count
+
+
+class JSONLWriter:
+
+    def __init__(self, f):
+        self.f = f
+
+    def write_batch(self, records):
+        self.f.write(''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in records))
+        self.f.flush()
+
+    def close(self):
+        pass
+
+
+class CSVWriter:
+    """Lists and dicts (authors, genres) are written as JSON, None as an empty string."""
+
+    def __init__(self, f):
+        self.f = f
+        self.writer = csv.DictWriter(f, CATALOG_FIELDS)
+        self.writer.writeheader()
+
+    def write_batch(self, records):
+        for r in records:
+            self.writer.writerow({
+                k: json.dumps(v, ensure_ascii=False) if isinstance(v, (list, dict)) else v
+                for k, v in r.items()
+            })
+        self.f.flush()
+
+    def close(self):
+        pass
+
+
+class ParquetWriter:
+    """Writes every batch as a row group of a parquet file, requires pyarrow."""
+
+    def __init__(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.schema = pa.schema([
+            ('path', pa.string()),
+            ('title', pa.string()),
+            ('authors', pa.list_(pa.string())),
+            ('genres', pa.list_(pa.struct([('genre', pa.string()), ('match', pa.int64())]))),
+            ('sequence_name', pa.string()),
+            ('sequence_number', pa.int64()),
+            ('lang', pa.string()),
+            ('src_lang', pa.string()),
+            ('date', pa.string()),
+            ('publisher', pa.string()),
+            ('publish_city', pa.string()),
+            ('publish_year', pa.int64()),
+            ('isbn', pa.string()),
+            ('error', pa.string()),
+        ])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write_batch(self, records):
+        self.writer.write_table(self.pa.Table.from_pylist(records, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
@@ -9,6 +9,28 @@ STRING_TAGS = [
     'code',
 ]
 
+# Descendants without which FB2Parser.parse fails, the parser looks them up recursively.
+# FictionBook itself may be anywhere in the document, description is checked
+# only as a child of FictionBook, as other descriptions are not parsed.
+REQUIRED_DESCENDANTS = {
+    'FictionBook': ['description', 'body'],
+    'description': ['title-info'],
+    'table': ['tr'],
+}
+
+# Children and attributes required by the format, but tolerated by FB2Parser.parse.
+RECOMMENDED_CHILDREN = {
+    'description': ['document-info'],
+    'title-info': ['genre', 'author', 'book-title'],
+    'src-title-info': ['genre', 'author', 'book-title'],
+    'body': ['section'],
+    'stanza': ['v'],
+}
+
+RECOMMENDED_ATTRIBUTES = {
+    'sequence': ['name'],
+}
+
 
 GENRES = {
     'sf_history': _('alternative history'), 'sf_action': _('Combat fiction'),
@@ -100,3 +122,11 @@ MESSAGES = {
     'edition_information': _('Edition information'),
     'contents': _('Table of contents'),
 }
+
+DEFAULT_LIMITS = {
+    'max_bytes': None,
+    'max_depth': None,
+    'max_elements': None,
+    'max_output_chars': None,
+    'max_time': None,
+}
@@ -0,0 +1,160 @@
+import io
+import mmap
+import os
+
+from bs4.builder import LXMLTreeBuilderForXML, ParserRejectedMarkup
+from bs4.dammit import EncodingDetector
+from bs4.element import XMLProcessingInstruction
+from lxml import etree
+
+HEAD_SIZE = 1024
+
+
+class StopParsing(Exception):
+    """Raised while the tree is built to stop reading the rest of the document."""
+
+
+class Source:
+    """A document read in chunks straight from a path, a binary file or a buffer.
+
+    Buffers (bytearray, memoryview, mmap) are sliced in place and files are
+    streamed, so the whole document is never copied into a bytes object.
+    The class intentionally has no read method: BeautifulSoup would call it
+    and load the whole file.
+    """
+
+    def __init__(self, obj, guard):
+        self.guard = guard
+        self.file = None
+        self.view = None
+        self.buffer = None
+        self.close_file = False
+        self.size = None
+        if isinstance(obj, os.PathLike):
+            self.file = open(obj, 'rb')
+            self.close_file = True
+        elif hasattr(obj, 'read') and not isinstance(obj, mmap.mmap):
+            self.file = obj
+        else:
+            self.view = memoryview(obj)
+            self.buffer = self.view.cast('B')
+            self.size = len(self.buffer)
+        self.start = 0
+        try:
+            if self.file is not None:
+                self.start = self.file.tell() if self.file.seekable() else None
+                self.size = self.get_file_size()
+            if self.size is not None:
+                self.guard.check('max_bytes', self.size)
+            self.head = self.read_at_start(HEAD_SIZE)
+        except BaseException:
+            self.close()
+            raise
+        self.skip = 0
+        self.position = None
+        self.bytes_read = 0
+
+    def __len__(self):
+        return self.size or 0
+
+    @property
+    def rewindable(self):
+        return self.start is not None
+
+    def get_file_size(self):
+        try:
+            size = os.fstat(self.file.fileno()).st_size
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return None
+        if self.start is None:
+            return None
+        return max(size - self.start, 0)
+
+    def read_at_start(self, size):
+        if self.buffer is not None:
+            return bytes(self.buffer[:size])
+        return self.file.read(size)
+
+    def rewind(self):
+        """Prepares reading from the start of the document, after a byte order mark if any."""
+        self.bytes_read = 0
+        if self.buffer is not None:
+            self.position = self.skip
+            return
+        if self.position is not None:
+            if not self.rewindable:
+                raise ValueError('Source is not seekable and was already read')
+            self.file.seek(self.start + len(self.head))
+        self.position = self.skip
+
+    def read_chunk(self, size):
+        if self.buffer is not None:
+            chunk = bytes(self.buffer[self.position:self.position + size])
+        elif self.position < len(self.head):
+            chunk = self.head[self.position:self.position + size]
+        else:
+            chunk = self.file.read(size)
+        self.position += len(chunk)
+        self.bytes_read += len(chunk)
+        self.guard.check('max_bytes', self.bytes_read)
+        return chunk
+
+    def close(self):
+        """Closes a file opened from a path and releases the views of a buffer,
+        so the caller can close its mmap even if a traceback keeps the source alive.
+        """
+        if self.close_file:
+            self.file.close()
+        if self.buffer is not None:
+            self.buffer.release()
+            self.view.release()
+
+
+class StreamingTreeBuilder(LXMLTreeBuilderForXML):
+    """lxml XML tree builder which feeds Source objects chunk by chunk.
+
+    A StopParsing raised by the soup ends the feeding without error.
+    """
+
+    def prepare_markup(self, markup, user_specified_encoding=None,
+                       exclude_encodings=None,
+                       document_declared_encoding=None):
+        if not isinstance(markup, Source):
+            yield from super().prepare_markup(
+                markup, user_specified_encoding,
+                exclude_encodings, document_declared_encoding,
+            )
+            return
+        self.processing_instruction_class = XMLProcessingInstruction
+        detector = EncodingDetector(
+            markup.head, known_definite_encodings=[user_specified_encoding],
+            user_encodings=[document_declared_encoding], is_html=False,
+            exclude_encodings=exclude_encodings,
+        )
+        markup.skip = len(markup.head) - len(detector.markup)
+        for encoding in detector.encodings:
+            yield markup, encoding, document_declared_encoding, False
+            if not markup.rewindable:
+                return
+
+    def feed(self, markup):
+        if isinstance(markup, Source):
+            markup.rewind()
+            read = markup.read_chunk
+        elif isinstance(markup, bytes):
+            read = io.BytesIO(markup).read
+        else:
+            read = io.StringIO(markup).read
+        try:
+            self.parser = self.parser_for(self.soup.original_encoding)
+            data = read(self.CHUNK_SIZE)
+            self.parser.feed(data)
+            while len(data) != 0:
+                data = read(self.CHUNK_SIZE)
+                if len(data) != 0:
+                    self.parser.feed(data)
+            self.parser.close()
+        except StopParsing:
+            pass
+        except (UnicodeDecodeError, LookupError, etree.ParserError) as e:
+            raise ParserRejectedMarkup(e)
@@ -0,0 +1,159 @@
+import codecs
+import io
+
+from bs4.dammit import EncodingDetector
+from lxml import etree
+
+from fb2parser.constants import (
+    REQUIRED_DESCENDANTS,
+    RECOMMENDED_CHILDREN,
+    RECOMMENDED_ATTRIBUTES,
+)
+from fb2parser.source import HEAD_SIZE, Source
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Validator:
+    """Checks the structure of a document with a streaming lxml parser.
+
+    No tree is built: every element is dropped as soon as it is closed.
+    The encoding is detected like in FB2Parser and undecodable bytes are
+    replaced instead of being reported, as the parser tolerates them too.
+    Problems have the same form as ParsingError.get_error(), their parameters
+    additionally contain path, line and fatal (True if FB2Parser.parse
+    would fail or the document is not well-formed XML).
+    """
+
+    def __init__(self, guard):
+        self.guard = guard
+        self.problems = []
+        self.stack = []
+        self.waiting = {}
+        self.root_found = False
+
+    def add_problem(self, name, params, fatal, path=None, line=None):
+        if path is None and self.stack:
+            path = self.stack[-1]['path']
+            if line is None:
+                line = self.stack[-1]['line']
+        self.problems.append((name, {
+            **params,
+            'path': path or '/',
+            'line': line,
+            'fatal': fatal,
+        }))
+
+    def detect_encoding(self, head):
+        """Returns the encoding FB2Parser would use and the length of the byte order mark."""
+        detector = EncodingDetector(head, is_html=False)
+        for encoding in detector.encodings:
+            try:
+                codecs.lookup(encoding)
+            except LookupError:
+                continue
+            return encoding, len(head) - len(detector.markup)
+        return 'utf-8', 0
+
+    def run(self, raw):
+        source = None
+        decoder = None
+        try:
+            if isinstance(raw, str):
+                self.guard.check('max_bytes', len(raw))
+                read = io.StringIO(raw).read
+            else:
+                if isinstance(raw, bytes):
+                    self.guard.check('max_bytes', len(raw))
+                    stream = io.BytesIO(raw)
+                    head = raw[:HEAD_SIZE]
+                else:
+                    source = Source(raw, self.guard)
+                    head = source.head
+                encoding, skip = self.detect_encoding(head)
+                if source is None:
+                    stream.seek(skip)
+                    read = stream.read
+                else:
+                    source.skip = skip
+                    source.rewind()
+                    read = source.read_chunk
+                decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+            # Nesting is limited by max_depth, not by libxml2's default of 256 levels.
+            parser = etree.XMLPullParser(events=('start', 'end'), resolve_entities=False, huge_tree=True)
+            while True:
+                data = read(CHUNK_SIZE)
+                text = data if decoder is None else decoder.decode(data, final=not data)
+                if text:
+                    parser.feed(text)
+                if not data:
+                    parser.close()
+                for event, element in parser.read_events():
+                    if event == 'start':
+                        self.start(element)
+                    else:
+                        self.end(element)
+                if not data:
+                    break
+        except etree.XMLSyntaxError as e:
+            self.add_problem('InvalidXML', {'message': e.msg}, True, line=e.lineno)
+        finally:
+            if source is not None:
+                source.close()
+        if not self.root_found and not self.problems:
+            self.add_problem('ElementNotFound', {'element_name': 'FictionBook'}, True)
+
+    def start(self, element):
+        self.guard.enter_element()
+        name = etree.QName(element).localname
+        parent = self.stack[-1] if self.stack else None
+        if parent:
+            parent['missing_children'].discard(name)
+            index = parent['counts'][name] = parent['counts'].get(name, 0) + 1
+            path = f'{parent["path"]}/{name}[{index}]'
+        else:
+            path = '/' + name
+        # Every open element waiting for such a descendant gets it.
+        for frame in self.waiting.pop(name, []):
+            frame['missing_descendants'].discard(name)
+        # Rules apply only inside the first FictionBook, the one FB2Parser finds.
+        inside = parent is not None and parent['name'] is not None
+        if not inside and name == 'FictionBook' and not self.root_found:
+            self.root_found = inside = True
+        if not inside:
+            name = None
+        required = REQUIRED_DESCENDANTS.get(name, [])
+        if name == 'description' and parent['name'] != 'FictionBook':
+            required = []
+        frame = {
+            'name': name,
+            'path': path,
+            'line': element.sourceline,
+            'missing_descendants': set(required),
+            'missing_children': set(RECOMMENDED_CHILDREN.get(name, [])),
+            'counts': {},
+        }
+        self.stack.append(frame)
+        for descendant in required:
+            self.waiting.setdefault(descendant, []).append(frame)
+        for attribute in RECOMMENDED_ATTRIBUTES.get(name, []):
+            if element.get(attribute) is None:
+                self.add_problem('AttributeNotFound', {'attribute_name': attribute}, False)
+
+    def end(self, element):
+        frame = self.stack[-1]
+        for descendant in REQUIRED_DESCENDANTS.get(frame['name'], []):
+            if descendant in frame['missing_descendants']:
+                # Elements are nested, so the closing one was the last to start waiting.
+                self.waiting[descendant].pop()
+                self.add_problem('ElementNotFound', {'element_name': descendant}, True)
+        for child in RECOMMENDED_CHILDREN.get(frame['name'], []):
+            if child in frame['missing_children']:
+                self.add_problem('ElementNotFound', {'element_name': child}, False)
+        self.stack.pop()
+        self.guard.leave_element()
+        element.clear()
+        parent = element.getparent()
+        if parent is not None:
+            while element.getprevious() is not None:
+                del parent[0]